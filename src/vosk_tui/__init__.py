@@ -5,11 +5,14 @@
 # For more help run: `python test_microphone.py -h`
 
 import argparse
-import json
-import queue
+import os
+import shutil
 import sys
 import tarfile
-from dataclasses import dataclass
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
 
@@ -22,85 +25,246 @@ from rich.panel import Panel
 from rich.table import Table
 from vosk import KaldiRecognizer, Model
 
+# orjson is optional, but parses recognizer results considerably faster
+try:
+    import orjson as json
+except ImportError:
+    import json
+
 # Since the the Panel isn't able to deal with overflow we just add an arbitrary cap
 # at the number of sentences that can be printed at the same time
 MAX_SENTENCES = 30
 
+# Log line for a completed sentence, filled in with hour, minute, second and text
+SENTENCE_FORMAT = "[green][{:02d}:{:02d}:{:02d}]:[reset] {}"
+
+# 16 kHz is the sample rate most Vosk models use (some use 8 kHz)
+MODEL_SAMPLERATE = 16000
+
+# Number of frames per audio block at the device's default sample rate, and how many
+# preallocated blocks to keep around
+BLOCK_SIZE = 8000
+BUFFER_POOL_SIZE = 8
+# Maximum number of queued blocks that are passed to the recognizer in one go
+MAX_BATCH_BLOCKS = 4
+
+# The UI is redrawn at this rate, so there is no point in updating it any faster
+REFRESH_PER_SECOND = 10
+UPDATE_INTERVAL = 1 / REFRESH_PER_SECOND
+UPDATE_INTERVAL_NS = 1_000_000_000 // REFRESH_PER_SECOND
+
+# Chunk size used when extracting downloaded model archives
+EXTRACT_BUFFER_SIZE = 1 << 20
+
 
 def main():
-    q = queue.Queue()
+    # A plain deque is cheaper than queue.Queue, which takes a lock and notifies a
+    # condition on every put. The event is only used to wake up the decoder.
+    q = deque()
+    have_data = threading.Event()
+
+    # Preallocated int16 buffers, so that the audio thread never has to allocate.
+    # Buffers travel to the decoder through `q` and are handed back afterwards.
+    # The pool is filled once the block size is known.
+    pool = deque()
+
+    # Stream status flags (e.g. input overflow) are reported by the UI loop,
+    # since printing from within the realtime audio thread is slow
+    statuses = deque()
 
     def callback(indata, frames, time, status):
         """This is called (from a separate thread) for each audio block."""
         if status:
-            print(status, file=sys.stderr)
-        q.put(bytes(indata))
+            statuses.append(status)
+        buf = pool.popleft() if pool else bytearray(frames * 2)
+        buf[: frames * 2] = indata
+        q.append((buf, frames))
+        have_data.set()
+
+    # Decoded text, as ("result" | "partial", text) pairs, for the UI to pick up.
+    # An ("error", exception) pair means the decoder has stopped.
+    results = deque()
+    have_results = threading.Event()
+
+    def decode_worker(rec: KaldiRecognizer, cpu: int | None):
+        """Feeds audio blocks to the recognizer (in a separate thread)."""
+        try:
+            pin_to_cpu(cpu)
+
+            # Look the recognizer methods up once rather than for every block
+            accept_waveform = rec.AcceptWaveform
+            result = rec.Result
+            partial_result = rec.PartialResult
+
+            while True:
+                while not q:
+                    have_data.wait()
+                    have_data.clear()
+                # If the decoder has fallen behind, catch up with fewer calls into Vosk.
+                # Vosk's cffi binding only accepts bytes (not bytearray or memoryview),
+                # so the join is the one copy each block goes through on its way to Kaldi.
+                batch = [q.popleft() for _ in range(min(len(q), MAX_BATCH_BLOCKS))]
+                data = b"".join(memoryview(buf)[: frames * 2] for buf, frames in batch)
+                pool.extend(buf for buf, _ in batch)
+
+                # Processes when a sentence has been completed
+                if accept_waveform(data):
+                    sentence = json.loads(result())["text"].strip()
+                    if sentence:
+                        results.append(("result", sentence))
+                # Process partial sentence
+                else:
+                    results.append(("partial", parse_partial(partial_result())))
+                have_results.set()
+        except Exception as e:
+            # Hand the error to the UI loop, which raises it outside of the live display
+            results.append(("error", e))
+            have_results.set()
 
     args = get_args()
 
     try:
-        # Fetch sample rate from device if it doesn't exist
+        # The model may have to be downloaded and extracted, so load it in the
+        # background while the audio device and layout are being set up. A daemon
+        # thread is used so that Ctrl-C or an error doesn't wait for it to finish.
+        loaded = {}
+
+        def load_in_background():
+            try:
+                loaded["model"] = load_model(args)
+            # Vosk calls sys.exit() for unknown models, so SystemExit is passed on too
+            except BaseException as e:
+                loaded["error"] = e
+
+        loader = threading.Thread(target=load_in_background, daemon=True)
+        loader.start()
+
+        # Pick a sample rate if none was given. Capturing at the model's rate lets
+        # the audio backend do the resampling instead of the recognizer, and if the
+        # device doesn't support that we fall back to its default rate.
+        args.blocksize = BLOCK_SIZE
         if args.samplerate is None:
             device_info = sd.query_devices(args.device, "input")
             # soundfile expects an int, sounddevice provides a float:
-            args.samplerate = int(device_info["default_samplerate"])
+            default_samplerate = int(device_info["default_samplerate"])
+            try:
+                sd.check_input_settings(
+                    args.device, channels=1, dtype="int16", samplerate=MODEL_SAMPLERATE
+                )
+                args.samplerate = MODEL_SAMPLERATE
+                # Scale the block size so that a block lasts as long as it would at
+                # the default rate, keeping partial results just as frequent
+                args.blocksize = BLOCK_SIZE * MODEL_SAMPLERATE // default_samplerate
+            except sd.PortAudioError:
+                args.samplerate = default_samplerate
             print(f"Using a sample rate of {args.samplerate}")
-
-        # Select model
-        if args.model is None:
-            model = Model(lang="en-us")
-        elif Path(args.model).exists():
-            model = Model(args.model)
-        elif repo_exists(args.model):
-            model = load_model_from_huggingface(args.model)
-        else:
-            model = Model(lang=args.model)
+        pool.extend(bytearray(args.blocksize * 2) for _ in range(BUFFER_POOL_SIZE))
 
         # Create base layout
         layout = make_layout()
         layout["header"].update(Header())
         layout["footer"].update(Footer(args))
-        layout["input"].update(Panel("", title="Live input"))
+        # The live input panel is kept around and its contents replaced in place
+        input_panel = Panel("", title="Live input")
+        layout["input"].update(input_panel)
+        # Only the most recent sentences are kept, as older ones can't be shown anyway
+        text_log = TextLog(deque(maxlen=MAX_SENTENCES))
+        layout["log"].update(text_log)
+
+        loader.join()
+        if "error" in loaded:
+            raise loaded["error"]
+        model = loaded["model"]
 
         with sd.RawInputStream(
             samplerate=args.samplerate,
-            blocksize=8000,
+            blocksize=args.blocksize,
             device=args.device,
             dtype="int16",
             channels=1,
             callback=callback,
         ):
             rec = KaldiRecognizer(model, args.samplerate)
-
-            completed_sentences = []
-            with Live(layout, refresh_per_second=10, screen=True):
-                layout["log"].update(TextLog(completed_sentences))
-
-                # Processing loop
+            # Decoding runs in its own thread, so that it overlaps with UI updates
+            threading.Thread(
+                target=decode_worker, args=(rec, args.cpu_decode), daemon=True
+            ).start()
+            # Pinning only now leaves the audio and decoder threads where they are
+            pin_to_cpu(args.cpu_ui)
+
+            pending_partial = None
+            last_update = 0
+            with Live(layout, refresh_per_second=REFRESH_PER_SECOND, screen=True):
+                # UI loop
                 while True:
-                    data = q.get()
-
-                    # Processes when a sentence has been completed
-                    if rec.AcceptWaveform(data):
-                        result = json.loads(rec.Result())
-                        sentence = result["text"].strip()
-                        if sentence:
-                            completed_sentences.append(
-                                f"[green][{datetime.now().time().isoformat(timespec='seconds')}]:[reset] {sentence}"
+                    # Partial results are coalesced to at most one per refresh
+                    now = time.monotonic_ns()
+                    if (
+                        pending_partial is not None
+                        and now - last_update > UPDATE_INTERVAL_NS
+                    ):
+                        if pending_partial != input_panel.renderable:
+                            input_panel.renderable = pending_partial
+                        pending_partial = None
+                        last_update = now
+
+                    while statuses:
+                        print(statuses.popleft(), file=sys.stderr)
+
+                    if not results:
+                        have_results.wait(UPDATE_INTERVAL)
+                        have_results.clear()
+                        continue
+                    kind, payload = results.popleft()
+
+                    if kind == "error":
+                        raise payload
+                    elif kind == "result":
+                        stamp = datetime.now()
+                        text_log.append(
+                            SENTENCE_FORMAT.format(
+                                stamp.hour, stamp.minute, stamp.second, payload
                             )
-                            layout["log"].update(TextLog(completed_sentences))
-                    # Process partial sentence
-                    else:
-                        result = json.loads(rec.PartialResult())
-                        layout["input"].update(
-                            Panel(result["partial"], title="Live input")
                         )
+                    else:
+                        pending_partial = payload
 
     except KeyboardInterrupt:
         print("\nDone")
         exit(0)
 
 
+def pin_to_cpu(cpu: int | None):
+    """Pin the calling thread to a single CPU, if one is given and it's supported."""
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu})
+
+
+def parse_partial(raw: str) -> str:
+    """Extract the text from a partial result, e.g. `{"partial" : "hello"}`.
+
+    Partial results arrive for nearly every audio block, so we slice the text out
+    directly and only fall back to a full JSON parse if it contains escapes.
+    """
+    start = raw.find('"', raw.find(":")) + 1
+    end = raw.rfind('"')
+    if 0 < start <= end and "\\" not in raw:
+        return raw[start:end]
+    return json.loads(raw)["partial"]
+
+
+def load_model(args: argparse.Namespace) -> Model:
+    """Select the model from the arguments, downloading it if needed."""
+    if args.model is None:
+        return Model(lang="en-us")
+    elif Path(args.model).exists():
+        return Model(args.model)
+    elif repo_exists(args.model):
+        return load_model_from_huggingface(args.model)
+    else:
+        return Model(lang=args.model)
+
+
 def load_model_from_huggingface(model_id: str) -> Model:
     if ":" in model_id:
         model, file_id = model_id.split(":", maxsplit=2)
@@ -122,9 +286,15 @@ def load_model_from_huggingface(model_id: str) -> Model:
 
     model_str_path = Path(hf_hub_download(model, file_id))
     extracted_path = model_str_path.parent / model_str_path.stem.split(".")[0]
-    print(f"Extracting model to {extracted_path}")
-    with tarfile.open(model_str_path) as tar:
-        tar.extractall(extracted_path)
+    # The archive only needs extracting once. It is extracted into a separate folder
+    # which is renamed when done, so an interrupted run doesn't leave half a model.
+    if not extracted_path.is_dir() or not any(extracted_path.iterdir()):
+        print(f"Extracting model to {extracted_path}")
+        partial_path = extracted_path.with_name(extracted_path.name + ".partial")
+        shutil.rmtree(partial_path, ignore_errors=True)
+        extract_model_archive(model_str_path, partial_path)
+        shutil.rmtree(extracted_path, ignore_errors=True)
+        partial_path.rename(extracted_path)
 
     # If there is only one folder in the extracted folder, enter it
     files = [*extracted_path.glob("*")]
@@ -134,6 +304,32 @@ def load_model_from_huggingface(model_id: str) -> Model:
     return Model(str(extracted_path))
 
 
+def extract_model_archive(archive_path: Path, extracted_path: Path):
+    """Extract a tar.gz archive into a fresh folder."""
+    # Stream through the archive, copying file contents in large chunks. Where
+    # tarfile supports extraction filters, the "data" filter is used to reject
+    # members that would end up outside of the extraction folder.
+    has_filter = hasattr(tarfile, "data_filter")
+    with tarfile.open(archive_path, mode="r|gz") as tar:
+        for member in tar:
+            if member.isreg():
+                if has_filter:
+                    member = tarfile.data_filter(member, str(extracted_path))
+                target = extracted_path / member.name
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with tar.extractfile(member) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, EXTRACT_BUFFER_SIZE)
+                # Keep the permissions and modification time recorded in the archive
+                if member.mode is not None:
+                    os.chmod(target, member.mode)
+                if member.mtime is not None:
+                    os.utime(target, (member.mtime, member.mtime))
+            elif has_filter:
+                tar.extract(member, extracted_path, filter="data")
+            else:
+                tar.extract(member, extracted_path)
+
+
 def make_layout() -> Layout:
     """Define the layout."""
     layout = Layout(name="root")
@@ -154,7 +350,19 @@ def make_layout() -> Layout:
 class Header:
     """Display header with clock."""
 
+    def __init__(self):
+        # The clock only changes once a second, so the panel is reused in between
+        self._last_second = None
+        self._cached_panel = None
+
     def __rich__(self) -> Panel:
+        # Compare whole seconds as integers, and only build a datetime when the
+        # displayed time actually changes
+        second = time.time_ns() // 1_000_000_000
+        if second == self._last_second and self._cached_panel is not None:
+            return self._cached_panel
+        now = datetime.fromtimestamp(second)
+
         grid = Table.grid(expand=True)
         grid.add_column(justify="left", ratio=1)
         grid.add_column(justify="center", ratio=1)
@@ -162,33 +370,46 @@ class Header:
         grid.add_row(
             "Prifysgol Bangor a ffrindiau",
             "[bold]Vosk Live Demo[reset]",
-            "[green]" + datetime.now().ctime().replace(":", "[blink]:[/]"),
+            "[green]" + now.ctime().replace(":", "[blink]:[/]"),
         )
-        return Panel(grid)
+        self._last_second = second
+        self._cached_panel = Panel(grid)
+        return self._cached_panel
 
 
 @dataclass
 class Footer:
     args: argparse.Namespace
+    _panel: Panel = field(init=False, repr=False)
 
-    def __rich__(self) -> Panel:
+    def __post_init__(self):
+        # The parameters don't change after startup, so the panel is only built once
         components = [
             f"Model: {self.args.model if self.args.model else 'en-us'}",
             f"Sample rate: {self.args.samplerate:,}",
-            f"Block size: {8000:,}",
+            f"Block size: {self.args.blocksize:,}",
         ]
-        return Panel(" | ".join(components), title="Parameters")
+        self._panel = Panel(" | ".join(components), title="Parameters")
+
+    def __rich__(self) -> Panel:
+        return self._panel
 
 
 @dataclass
 class TextLog:
-    sentences: list[str]
+    sentences: deque[str]
+    _panel: Panel = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # The panel is only touched when a sentence is added, not on every refresh
+        self._panel = Panel("\n".join(self.sentences), title="Sentence log")
+
+    def append(self, sentence: str):
+        self.sentences.append(sentence)
+        self._panel.renderable = "\n".join(self.sentences)
 
     def __rich__(self) -> Panel:
-        return Panel(
-            "\n".join(self.sentences[-MAX_SENTENCES:]),
-            title="Sentence log",
-        )
+        return self._panel
 
 
 def get_args() -> argparse.Namespace:
@@ -227,5 +448,24 @@ def get_args() -> argparse.Namespace:
         type=str,
         help="language model; e.g. en-us, fr, nl; default is en-us",
     )
+    parser.add_argument(
+        "--cpu-ui", type=int, help="pin the UI thread to this CPU (Linux only)"
+    )
+    parser.add_argument(
+        "--cpu-decode", type=int, help="pin the decoder thread to this CPU (Linux only)"
+    )
     args = parser.parse_args(remaining)
+
+    # Catch unusable CPUs here, rather than from within the running threads
+    if hasattr(os, "sched_getaffinity"):
+        available = os.sched_getaffinity(0)
+        for option, cpu in (
+            ("--cpu-ui", args.cpu_ui),
+            ("--cpu-decode", args.cpu_decode),
+        ):
+            if cpu is not None and cpu not in available:
+                parser.error(
+                    f"{option}: CPU {cpu} is not available, choose one of "
+                    f"{', '.join(map(str, sorted(available)))}"
+                )
     return args